@@ -10,5 +10,10 @@ from __future__ import absolute_import
 
 __version__ = "0.0.1"
 
-# do imports of all of the functions that should be available here
-from .ants_seg_to_nidm import add_seg_data
+# functions that should be available here, imported on first use so light commands
+# (e.g. antsegquery) don't load nidm/rdflib
+def __getattr__(name):
+    if name == "add_seg_data":
+        from .ants_seg_to_nidm import add_seg_data
+        return add_seg_data
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -45,7 +45,7 @@ from prov.model import Namespace as provNamespace
 # standard library
 from pickle import dumps
 import os
-from os.path import join,dirname
+from os.path import join,dirname,basename,abspath,relpath
 from socket import getfqdn
 import glob
 
@@ -58,8 +58,10 @@ import pandas as pd
 
 from pathlib import Path
 
-from rdflib import Graph, RDF, URIRef, util, term,Namespace,Literal,BNode,XSD
-from ants_seg_to_nidm.antsutils import read_ants_stats, create_cde_graph, convert_stats_to_nidm
+from rdflib import Graph, RDF, RDFS, URIRef, util, term,Namespace,Literal,BNode,XSD
+from ants_seg_to_nidm.antsutils import read_ants_stats, create_cde_graph, convert_stats_to_nidm, write_cde_sidecar, url_validator
+from ants_seg_to_nidm.jsonldutils import write_stats_jsonld, dump_stats_jsonld
+from ants_seg_to_nidm.measuredb import add_subject
 from io import StringIO
 
 import tempfile
@@ -68,19 +70,6 @@ import tempfile
 
 
 
-def url_validator(url):
-    '''
-    Tests whether url is a valide url
-    :param url: url to test
-    :return: True for valid url else False
-    '''
-    try:
-        result = urlparse(url)
-        return all([result.scheme, result.netloc, result.path])
-
-    except:
-        return False
-
 def add_seg_data(nidmdoc,subjid,stats_entity_id, add_to_nidm=False, forceagent=False):
     '''
     WIP: this function creates a NIDM file of brain volume data and if user supplied a NIDM-E file it will add brain volumes to the
@@ -222,6 +211,44 @@ def add_seg_data(nidmdoc,subjid,stats_entity_id, add_to_nidm=False, forceagent=F
         nidmdoc.add((software_activity, Constants.DCT["isPartOf"], row['project']))
 
 
+def convert_measures(measures, subjid, jsonld=False, add_de=False, data_dictionary=None):
+    '''
+    Creates a new NIDM document for one subject's ANTS measures
+    :param measures: list of (cde id, value) tuples as returned by read_ants_stats
+    :param subjid: subject identifier
+    :param jsonld: if True the document is serialized as JSON-LD else TURTLE
+    :param add_de: if True the definitions of the CDEs used by measures are added to the document
+    :param data_dictionary: optional (relative) IRI of the CDE data dictionary file to reference
+    :return: serialized NIDM document
+    '''
+    if jsonld:
+        fp = StringIO()
+        dump_stats_jsonld(fp, measures, subjid, add_de=add_de, data_dictionary=data_dictionary)
+        return fp.getvalue()
+
+    [e,doc] = convert_stats_to_nidm(measures)
+
+    # convert nidm stats graph to rdflib
+    g2 = Graph()
+    g2.parse(source=StringIO(doc.serialize(format='rdf',rdf_format='turtle')),format='turtle')
+
+    if add_de:
+        nidmdoc = create_cde_graph(restrict_to={cde_id for cde_id, _ in measures}) + g2
+    else:
+        nidmdoc = g2
+
+    add_seg_data(nidmdoc=nidmdoc,subjid=subjid,stats_entity_id=e.identifier)
+
+    if data_dictionary is not None:
+        nidmdoc.add((URIRef(e.identifier.uri),RDFS.seeAlso,URIRef(data_dictionary)))
+
+    data = nidmdoc.serialize(format='turtle')
+    # rdflib < 6 returns bytes
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return data
+
+
 def test_connection(remote=False):
     """helper function to test whether an internet connection exists.
     Used for preventing timeout errors when scraping interlex."""
@@ -262,14 +289,17 @@ def main():
     parser.add_argument('-j', '--jsonld', dest='jsonld', action='store_true', default = False,
                         help='If flag set then NIDM file will be written as JSONLD instead of TURTLE')
     parser.add_argument('-add_de', '--add_de', dest='add_de', action='store_true', default = None,
-                        help='If flag set then data element data dictionary will be added to nidm file else it will written to a'
-                            'separate file as ants_cde.ttl in the output directory (or same directory as nidm file if -n paramemter'
-                            'is used.')
+                        help='If flag set then the data elements used by the subject will be added to nidm file else the data '
+                            'dictionary will be written once to a separate file ants_cde_<registry hash>.ttl in the output '
+                            'directory and referenced from the nidm file.')
     parser.add_argument('-n','--nidm', dest='nidm_file', type=str, required=False,
                         help='Optional NIDM file to add segmentation data to.')
     parser.add_argument('-forcenidm','--forcenidm', action='store_true',required=False,
                         help='If adding to NIDM file this parameter forces the data to be added even if the participant'
                              'doesnt currently exist in the NIDM file.')
+    parser.add_argument('-index', '--index', dest='index', type=str, required=False,
+                        help='Optional SQLite index the subject\'s measures are added to for fast lookups with '
+                             'antsegquery.')
     args = parser.parse_args()
 
     # test whether user supplied stats file directly and if so they the subject id must also be supplied so we
@@ -349,12 +379,11 @@ def main():
 
 
     measures = read_ants_stats(labelstats,brainvol,imagefile)
-    [e,doc] = convert_stats_to_nidm(measures)
-    g = create_cde_graph()
 
-    # convert nidm stats graph to rdflib
-    g2 = Graph()
-    g2.parse(source=StringIO(doc.serialize(format='rdf',rdf_format='turtle')),format='turtle')
+    # without -add_de the data dictionary is written once per output directory and referenced from the NIDM file,
+    # with -add_de only the CDEs used by this subject are added to the NIDM file
+    if args.add_de is None:
+        data_dictionary = write_cde_sidecar(dirname(args.output_dir))
 
 
     # for measures we need to create NIDM structures using anatomy mappings
@@ -368,32 +397,30 @@ def main():
         output_filename = args.subjid + "_NIDM"
         # If user did not choose to add this data to an existing NIDM file then create a new one for the CSV data
 
-        if args.add_de is not None:
-            nidmdoc = g+g2
-        else:
-            nidmdoc = g2
-
-        # print(nidmdoc.serializeTurtle())
-
-        # add seg data to new NIDM file
-        add_seg_data(nidmdoc=nidmdoc,subjid=args.subjid,stats_entity_id=e.identifier)
-
         #serialize NIDM file
         print("Writing NIDM file...")
+        nidm_output = args.output_dir
+        # the data dictionary is in the same directory as the NIDM file
+        reference = basename(data_dictionary) if args.add_de is None else None
         if args.jsonld is not False:
-            # nidmdoc.serialize(destination=join(args.output_dir,output_filename +'.json'),format='jsonld')
-            nidmdoc.serialize(destination=join(args.output_dir),format='jsonld')
+            # new JSON-LD files have a fixed shape so stream them directly without building the rdflib graph
+            write_stats_jsonld(args.output_dir, measures, args.subjid, add_de=args.add_de is not None,
+                               data_dictionary=reference)
         else:
             # nidmdoc.serialize(destination=join(args.output_dir,output_filename +'.ttl'),format='turtle')
-            nidmdoc.serialize(destination=join(args.output_dir),format='turtle')
-        # added to support separate cde serialization
-        if args.add_de is None:
-            # serialize cde graph
-            g.serialize(destination=join(dirname(args.output_dir),"ants_cde.ttl"),format='turtle')
+            with open(args.output_dir, 'w') as fp:
+                fp.write(convert_measures(measures, args.subjid, add_de=args.add_de is not None,
+                                          data_dictionary=reference))
 
         #nidmdoc.save_DotGraph(join(args.output_dir,output_filename + ".pdf"), format="pdf")
     # we adding these data to an existing NIDM file
     else:
+        [e,doc] = convert_stats_to_nidm(measures)
+
+        # convert nidm stats graph to rdflib
+        g2 = Graph()
+        g2.parse(source=StringIO(doc.serialize(format='rdf',rdf_format='turtle')),format='turtle')
+
         #read in NIDM file with rdflib
         print("Reading in NIDM graph....")
         g1 = Graph()
@@ -401,6 +428,7 @@ def main():
 
         if args.add_de is not None:
             print("Combining graphs...")
+            g = create_cde_graph(restrict_to={cde_id for cde_id, _ in measures})
             nidmdoc = g + g1 + g2
         else:
             nidmdoc = g1 + g2
@@ -410,17 +438,23 @@ def main():
         else:
             add_seg_data(nidmdoc=nidmdoc,subjid=args.subjid,stats_entity_id=e.identifier,add_to_nidm=True)
 
+        if args.add_de is None:
+            # reference the data dictionary relative to the augmented NIDM file
+            reference = Path(relpath(abspath(data_dictionary), dirname(abspath(args.nidm_file)))).as_posix()
+            nidmdoc.add((URIRef(e.identifier.uri),RDFS.seeAlso,URIRef(reference)))
 
         #serialize NIDM file
         print("Writing Augmented NIDM file...")
         if args.jsonld is not False:
-            nidmdoc.serialize(destination=args.nidm_file + '.json',format='jsonld')
+            nidm_output = args.nidm_file + '.json'
+            nidmdoc.serialize(destination=nidm_output,format='jsonld')
         else:
-            nidmdoc.serialize(destination=args.nidm_file,format='turtle')
+            nidm_output = args.nidm_file
+            nidmdoc.serialize(destination=nidm_output,format='turtle')
 
-        if args.add_de is None:
-            # serialize cde graph
-            g.serialize(destination=join(dirname(args.output_dir),"ants_cde.ttl"),format='turtle')
+    if args.index is not None:
+        print("Adding measures to index...")
+        add_subject(args.index, args.subjid, measures, nidm_file=nidm_output)
 
 
 if __name__ == "__main__":
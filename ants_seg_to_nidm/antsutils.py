@@ -3,13 +3,18 @@
 
 """
 
+import hashlib
 import json
 import os
-from collections import namedtuple
+import tempfile
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import rdflib as rl
+from urllib.parse import urlparse
 from requests import get
 import nibabel as nib
+from nibabel.arrayproxy import ArrayProxy
+from nibabel.openers import ImageOpener
 import numpy as np
 import pandas as pd
 
@@ -18,6 +23,23 @@ cde_file = Path(os.path.dirname(__file__)) / "mapping_data" / "ants-cdes.json"
 map_file = Path(os.path.dirname(__file__)) / "mapping_data" / "antsmap.json"
 lut_file = Path(os.path.dirname(__file__)) / "mapping_data" / "FreeSurferColorLUT.txt"
 
+# largest amount of image data read at once by iter_image_slabs
+SLAB_BYTES = 64 * 1024 * 1024
+
+
+def url_validator(url):
+    '''
+    Tests whether url is a valide url
+    :param url: url to test
+    :return: True for valid url else False
+    '''
+    try:
+        result = urlparse(url)
+        return all([result.scheme, result.netloc, result.path])
+
+    except:
+        return False
+
 
 def get_id_to_struct(id):
     with open(lut_file, "r") as fp:
@@ -51,6 +73,42 @@ def get_details(key, structure):
     return hemi, measure, unit
 
 
+def get_brainvols_key(key):
+    """Return the CDE key for a column of the ANTS brainvols file
+
+    :param key: column name
+    :return: ANTSDKT key
+    """
+    return ANTSDKT(
+        structure=key if "vol" in key.lower() else "Brain",
+        hemi=None,
+        measure="Volume" if "vol" in key.lower() else key,
+        unit="mm^3"
+        if "vol" in key.lower()
+        else "mm"
+        if "Thickness" in key
+        else None,
+    )
+
+
+def get_labelstats_keys(key, structure):
+    """Return the CDE keys for a column of the ANTS labelstats file
+
+    Only VolumeInVoxels and Area columns have CDEs, for VolumeInVoxels the last key is the
+    derived volume in mm^3
+    :param key: column name
+    :param structure: structure name of the row's label
+    :return: list of ANTSDKT keys
+    """
+    if "VolumeInVoxels" not in key and "Area" not in key:
+        return []
+    hemi, measure, unit = get_details(key, structure)
+    keys = [ANTSDKT(structure=structure, hemi=hemi, measure=measure, unit=unit)]
+    if "VolumeInVoxels" in key:
+        keys.append(ANTSDKT(structure=structure, hemi=hemi, measure="Volume", unit="mm^3"))
+    return keys
+
+
 def read_ants_stats(ants_stats_file, ants_brainvols_file, mri_file, force_error=True):
     """
     Reads in an ANTS stats file along with associated mri_file (for voxel sizes) and converts to a measures dictionary with keys:
@@ -81,16 +139,7 @@ def read_ants_stats(ants_stats_file, ants_brainvols_file, mri_file, force_error=
     # iterate over columns in brain vols
     for key, j in brain_vols.T.iterrows():
         value = j.values[0]
-        keytuple = ANTSDKT(
-            structure=key if "vol" in key.lower() else "Brain",
-            hemi=None,
-            measure="Volume" if "vol" in key.lower() else key,
-            unit="mm^3"
-            if "vol" in key.lower()
-            else "mm"
-            if "Thickness" in key
-            else None,
-        )
+        keytuple = get_brainvols_key(key)
         if str(keytuple) not in ants_cde:
             ants_cde["count"] += 1
             ants_cde[str(keytuple)] = {
@@ -107,42 +156,17 @@ def read_ants_stats(ants_stats_file, ants_brainvols_file, mri_file, force_error=
 
     # iterate over columns in brain vols
     for row in ants_stats.iterrows():
-        structure = None
+        # the structure applies to all columns of the row wherever the Label column is
+        segid = int(row[1]["Label"])
+        structure = get_id_to_struct(segid)
+        if structure is None:
+            raise ValueError(f"{segid:d} did not return any structure")
         for key, val in row[1].items():
             if key == "Label":
-                segid = int(val)
-                structure = get_id_to_struct(segid)
-                if structure is None:
-                    raise ValueError(f"{int(val):d} did not return any structure")
-                continue
-            if "VolumeInVoxels" not in key and "Area" not in key:
                 continue
-            hemi, measure, unit = get_details(key, structure)
-            key_tuple = ANTSDKT(
-                structure=structure, hemi=hemi, measure=measure, unit=unit
-            )
-            label = f"{structure} {measure} ({unit})"
-            if str(key_tuple) not in ants_cde:
-                ants_cde["count"] += 1
-                ants_cde[str(key_tuple)] = {
-                    "id": f"{ants_cde['count']:0>6d}",
-                    "structure_id": segid,
-                    "label": label,
-                }
-                if force_error:
-                    raise ValueError(
-                        f"Key {key_tuple} not found in ANTS data elements file"
-                    )
-                changed = True
-            # measures.append((f'{ants_cde[str(key_tuple)]["id"]}', str(val)))
-
-            if "VolumeInVoxels" in key:
-                measure = "Volume"
-                unit = "mm^3"
-                key_tuple = ANTSDKT(
-                    structure=structure, hemi=hemi, measure=measure, unit=unit
-                )
-                label = f"{structure} {measure} ({unit})"
+            key_tuples = get_labelstats_keys(key, structure)
+            for key_tuple in key_tuples:
+                label = f"{structure} {key_tuple.measure} ({key_tuple.unit})"
                 if str(key_tuple) not in ants_cde:
                     ants_cde["count"] += 1
                     ants_cde[str(key_tuple)] = {
@@ -155,8 +179,11 @@ def read_ants_stats(ants_stats_file, ants_brainvols_file, mri_file, force_error=
                             f"Key {key_tuple} not found in ANTS data elements file"
                         )
                     changed = True
+            # measures.append((f'{ants_cde[str(key_tuple)]["id"]}', str(val)))
+
+            if "VolumeInVoxels" in key:
                 measures.append(
-                    (f'{ants_cde[str(key_tuple)]["id"]}', str(val * vox_size))
+                    (f'{ants_cde[str(key_tuples[-1])]["id"]}', str(val * vox_size))
                 )
 
     if changed:
@@ -166,6 +193,152 @@ def read_ants_stats(ants_stats_file, ants_brainvols_file, mri_file, force_error=
     return measures
 
 
+def _load_image(mri_file):
+    if isinstance(mri_file, nib.spatialimages.SpatialImage):
+        return mri_file
+    return nib.load(mri_file)
+
+
+def iter_image_slabs(mri_file, max_bytes=SLAB_BYTES):
+    """Read an image slab by slab so voxel data never has to fit in memory at once
+
+    Slabs are consecutive planes along the third axis (and beyond, for images with more than
+    3 dimensions). Uncompressed images are memory mapped, compressed images (e.g. .nii.gz) are
+    decompressed as a stream.
+    :param mri_file: image file readable by nibabel or an already loaded nibabel image
+    :param max_bytes: maximum size of a slab in bytes, at least one plane is always read
+    :return: generator of (first plane, slab) where slab has shape (x, y, planes)
+    """
+    img = _load_image(mri_file)
+    proxy = img.dataobj
+    shape = img.shape + (1,) * (3 - len(img.shape))
+    nplanes = int(np.prod(shape[2:]))
+    plane_shape = (shape[1], shape[0])
+
+    if not isinstance(proxy, ArrayProxy) or proxy.order != "F" or not isinstance(proxy.file_like, str):
+        # not a simple on-disk array, fall back to nibabel's own slicing
+        if len(img.shape) < 3:
+            yield 0, np.asanyarray(proxy).reshape(shape)
+            return
+        planes = max(1, max_bytes // (shape[0] * shape[1] * img.get_data_dtype().itemsize))
+        # slabs don't cross volumes of images with more than 3 dimensions
+        for volume in range(int(np.prod(shape[3:]))):
+            index = np.unravel_index(volume, shape[3:], order="F")
+            for start in range(0, shape[2], planes):
+                slab = proxy[(slice(None), slice(None), slice(start, start + planes)) + index]
+                yield volume * shape[2] + start, np.asanyarray(slab)
+        return
+
+    def scale(slab):
+        if proxy.slope != 1 or proxy.inter != 0:
+            return slab * proxy.slope + proxy.inter
+        return slab
+
+    dtype = proxy.dtype
+    plane_bytes = shape[0] * shape[1] * dtype.itemsize
+    planes = max(1, max_bytes // plane_bytes)
+
+    if Path(proxy.file_like).suffix not in ImageOpener.compress_ext_map:
+        data = np.memmap(
+            proxy.file_like, dtype=dtype, mode="r", offset=proxy.offset, shape=(nplanes,) + plane_shape
+        )
+        for start in range(0, nplanes, planes):
+            yield start, scale(data[start : start + planes].T)
+        return
+
+    with ImageOpener(proxy.file_like) as fp:
+        fp.seek(proxy.offset)
+        for start in range(0, nplanes, planes):
+            count = min(planes, nplanes - start)
+            buf = fp.read(count * plane_bytes)
+            if len(buf) != count * plane_bytes:
+                raise ValueError(f"{mri_file} is truncated")
+            yield start, scale(np.frombuffer(buf, dtype=dtype).reshape((count,) + plane_shape).T)
+
+
+def map_image_slabs(mri_file, func, max_bytes=SLAB_BYTES, nproc=1):
+    """Apply func to each slab of an image
+
+    With nproc > 1 slabs are processed by a thread pool while the next ones are read, at most
+    nproc + 1 slabs are in memory at a time.
+    :param mri_file: image file readable by nibabel or an already loaded nibabel image
+    :param func: function called with each slab as returned by iter_image_slabs
+    :param max_bytes: maximum size of a slab in bytes
+    :param nproc: number of slabs processed at the same time
+    :return: generator of func results in slab order
+    """
+    slabs = iter_image_slabs(mri_file, max_bytes=max_bytes)
+    if nproc <= 1:
+        for _, slab in slabs:
+            yield func(slab)
+        return
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        pending = deque()
+        for _, slab in slabs:
+            if len(pending) >= nproc:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, slab))
+        while pending:
+            yield pending.popleft().result()
+
+
+def _count_labels(slab):
+    slab = slab.ravel(order="K")
+    if slab.dtype.kind in "iu" and slab.size and 0 <= slab.min() and slab.max() < 2 ** 20:
+        # bincount only takes types that cast safely to intp, uint64 doesn't
+        counts = np.bincount(slab.astype(np.intp, copy=False))
+        labels = np.nonzero(counts)[0]
+        return labels, counts[labels]
+    return np.unique(slab, return_counts=True)
+
+
+def count_label_voxels(mri_file, max_bytes=SLAB_BYTES, nproc=1):
+    """Count the voxels of each label in a segmentation image with bounded memory
+
+    :param mri_file: segmentation image file or loaded nibabel image
+    :param max_bytes: maximum size of a slab in bytes
+    :param nproc: number of slabs processed at the same time
+    :return: dictionary of label -> number of voxels
+    """
+    totals = Counter()
+    for labels, counts in map_image_slabs(mri_file, _count_labels, max_bytes=max_bytes, nproc=nproc):
+        for label, count in zip(labels.tolist(), counts.tolist()):
+            totals[int(round(label))] += count
+    return dict(totals)
+
+
+def get_label_volumes(mri_file, max_bytes=SLAB_BYTES, nproc=1):
+    """Volume in mm^3 of each label in a segmentation image
+
+    :param mri_file: segmentation image file or loaded nibabel image
+    :param max_bytes: maximum size of a slab in bytes
+    :param nproc: number of slabs processed at the same time
+    :return: dictionary of label -> volume in mm^3
+    """
+    vox_size = float(np.prod(_load_image(mri_file).header.get_zooms()[:3]))
+    counts = count_label_voxels(mri_file, max_bytes=max_bytes, nproc=nproc)
+    return {label: count * vox_size for label, count in counts.items()}
+
+
+def check_label_volumes(ants_stats_file, mri_file, max_bytes=SLAB_BYTES, nproc=1):
+    """Cross-check VolumeInVoxels of an ANTS labelstats file against the label image it was computed from
+
+    :param ants_stats_file: path (or file object) of ANTS segmentation output file named "antslabelstats"
+    :param mri_file: segmentation image file or loaded nibabel image
+    :param max_bytes: maximum size of a slab in bytes
+    :param nproc: number of slabs processed at the same time
+    :return: list of (label, VolumeInVoxels, voxels in image) for the labels that don't match
+    """
+    ants_stats = pd.read_csv(ants_stats_file)
+    counts = count_label_voxels(mri_file, max_bytes=max_bytes, nproc=nproc)
+    mismatches = []
+    for label, voxels in zip(ants_stats["Label"], ants_stats["VolumeInVoxels"]):
+        image_voxels = counts.get(int(label), 0)
+        if int(round(voxels)) != image_voxels:
+            mismatches.append((int(label), int(round(voxels)), image_voxels))
+    return mismatches
+
+
 def hemiless(key):
     return (
         key.replace("-lh-", "-")
@@ -234,6 +407,7 @@ def create_cde_graph(restrict_to=None):
     """
     with open(cde_file, "r") as fp:
         ants_cde = json.load(fp)
+    import rdflib as rl
     from nidm.core import Constants
 
     ants = Constants.ANTS
@@ -285,6 +459,37 @@ def create_cde_graph(restrict_to=None):
     return g
 
 
+def get_cde_hash():
+    """Short content hash of the CDE registry (ants-cdes.json)"""
+    with open(cde_file, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()[:12]
+
+
+def get_cde_sidecar_name():
+    """Name of the CDE data dictionary file for the current CDE registry
+
+    The name contains a hash of ants-cdes.json so a dataset only needs one copy per registry version
+    """
+    return f"ants_cde_{get_cde_hash()}.ttl"
+
+
+def write_cde_sidecar(output_dir):
+    """Write the CDE data dictionary to output_dir unless it is already there
+
+    :param output_dir: directory shared by the NIDM files that reference the data dictionary
+    :return: path of the data dictionary file
+    """
+    path = os.path.join(output_dir, get_cde_sidecar_name())
+    if not os.path.exists(path):
+        # write to a temporary file first so concurrent runs never see a partial file
+        fd, temp = tempfile.mkstemp(dir=output_dir or ".", suffix=".ttl")
+        os.close(fd)
+        create_cde_graph().serialize(destination=temp, format="turtle")
+        os.chmod(temp, 0o644)
+        os.replace(temp, path)
+    return path
+
+
 def convert_stats_to_nidm(stats):
     """Convert a stats record into a NIDM entity
 
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Utilities for writing ANTS segmentation statistics directly as JSON-LD
+
+The documents written here have a fixed shape (one stats collection, one
+activity, two qualified associations, the agents and optionally the CDE
+definitions) so they are emitted straight from the measures and the CDE
+registry using a precomputed @context instead of going through rdflib.
+"""
+
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from ants_seg_to_nidm.antsutils import ANTSDKT, cde_file
+
+context_file = Path(os.path.dirname(__file__)) / "mapping_data" / "ants-context.jsonld"
+
+RDFS = "http://www.w3.org/2000/01/rdf-schema#"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+
+@lru_cache(maxsize=None)
+def load_context():
+    """Load the shipped JSON-LD @context
+
+    :return: dictionary as found in the @context of the file
+    """
+    with open(context_file, "r") as fp:
+        return json.load(fp)["@context"]
+
+
+@lru_cache(maxsize=None)
+def load_prefixes():
+    """Prefixes defined by the shipped JSON-LD @context
+
+    :return: dictionary mapping prefixes to namespace IRIs
+    """
+    prefixes = {}
+    for prefix, definition in load_context().items():
+        if prefix.startswith("@"):
+            continue
+        # namespaces not ending in / or # (e.g. ilx_) are expanded term definitions with @prefix
+        prefixes[prefix] = definition["@id"] if isinstance(definition, dict) else definition
+    return prefixes
+
+
+def compact_iri(iri):
+    """Compact an IRI against the shipped @context
+
+    :param iri: full IRI
+    :return: prefix:suffix if a namespace in the context matches else the IRI itself
+    """
+    iri = str(iri)
+    matches = [
+        (len(ns), prefix, ns)
+        for prefix, ns in load_prefixes().items()
+        if iri.startswith(ns) and len(iri) > len(ns)
+    ]
+    if not matches:
+        return iri
+    _, prefix, ns = max(matches)
+    return prefix + ":" + iri[len(ns):]
+
+
+def _uri(term):
+    # prov QualifiedNames carry their IRI in .uri, rdflib terms are strings
+    return getattr(term, "uri", None) or str(term)
+
+
+def _ref(iri):
+    return {"@id": compact_iri(iri)}
+
+
+def _typed(value, datatype):
+    return {"@value": value, "@type": compact_iri(XSD + datatype)}
+
+
+def _literal(item):
+    """Mirror rdflib.Literal(item) for the python types found in the CDE registry"""
+    if isinstance(item, bool):
+        return _typed(str(item).lower(), "boolean")
+    if isinstance(item, int):
+        return _typed(str(item), "integer")
+    if isinstance(item, float):
+        return _typed(repr(item), "double")
+    return str(item)
+
+
+def _add(node, predicate, value):
+    values = node.setdefault(compact_iri(predicate), [])
+    if value not in values:
+        values.append(value)
+
+
+def iter_stats_nodes(measures, subjid, stats_entity_id=None, data_dictionary=None):
+    """Generate the JSON-LD nodes for one subject's stats collection
+
+    Produces the same triples as convert_stats_to_nidm followed by add_seg_data
+    for a new NIDM file.
+    :param measures: list of (cde id, value) tuples as returned by read_ants_stats
+    :param subjid: subject identifier
+    :param stats_entity_id: optional IRI of the stats collection, minted if not given
+    :param data_dictionary: optional (relative) IRI of the CDE data dictionary file
+    :return: generator of node dictionaries
+    """
+    from nidm.core import Constants
+    from nidm.experiment.Core import getUUID
+
+    prov = str(Constants.PROV)
+    niiri = str(Constants.NIIRI)
+    ants = str(Constants.ANTS)
+
+    if stats_entity_id is None:
+        stats_entity_id = niiri + getUUID()
+    software_activity = niiri + getUUID()
+    software_agent = niiri + getUUID()
+    participant_agent = niiri + getUUID()
+
+    stats = {
+        "@id": compact_iri(_uri(stats_entity_id)),
+        "@type": [compact_iri(prov + "Entity"), compact_iri(Constants.NIDM["ANTSStatsCollection"])],
+    }
+    for cde_id, value in measures:
+        _add(stats, ants + "ants_" + cde_id, _typed(value, "float" if "." in value else "integer"))
+    _add(stats, prov + "wasGeneratedBy", _ref(software_activity))
+    if data_dictionary is not None:
+        _add(stats, RDFS + "seeAlso", {"@id": data_dictionary})
+    yield stats
+
+    yield {
+        "@id": compact_iri(software_activity),
+        "@type": [compact_iri(prov + "Activity")],
+        compact_iri(Constants.DCT["description"]): ["ANTS segmentation statistics"],
+        compact_iri(prov + "qualifiedAssociation"): [
+            {
+                "@type": [compact_iri(prov + "Association")],
+                compact_iri(prov + "hadRole"): [_ref(_uri(Constants.NIDM_NEUROIMAGING_ANALYSIS_SOFTWARE))],
+                compact_iri(prov + "agent"): [_ref(software_agent)],
+            },
+            {
+                "@type": [compact_iri(prov + "Association")],
+                compact_iri(prov + "hadRole"): [_ref(Constants.SIO["Subject"])],
+                compact_iri(prov + "agent"): [_ref(participant_agent)],
+            },
+        ],
+    }
+
+    yield {
+        "@id": compact_iri(software_agent),
+        "@type": [compact_iri(prov + "Agent"), compact_iri(prov + "SoftwareAgent")],
+        compact_iri(_uri(Constants.NIDM_NEUROIMAGING_ANALYSIS_SOFTWARE)): [_ref(ants)],
+    }
+
+    yield {
+        "@id": compact_iri(participant_agent),
+        "@type": [compact_iri(prov + "Agent")],
+        compact_iri(_uri(Constants.NIDM_SUBJECTID)): [_typed(subjid, "string")],
+    }
+
+
+def iter_cde_nodes(restrict_to=None):
+    """Generate the JSON-LD nodes for the ANTS CDEs
+
+    Produces the same triples as create_cde_graph.
+    :param restrict_to: optional collection of CDE ids to include
+    :return: generator of node dictionaries
+    """
+    from nidm.core import Constants
+
+    with open(cde_file, "r") as fp:
+        ants_cde = json.load(fp)
+
+    ants = str(Constants.ANTS)
+    nidm = str(Constants.NIDM)
+
+    yield {
+        "@id": compact_iri(ants + "DataElement"),
+        compact_iri(RDFS + "subClassOf"): [_ref(nidm + "DataElement")],
+    }
+
+    for key, value in ants_cde.items():
+        if key == "count":
+            continue
+        if restrict_to is not None:
+            if value["id"] not in restrict_to:
+                continue
+        node = {
+            "@id": compact_iri(ants + "ants_" + value["id"]),
+            "@type": [compact_iri(ants + "DataElement")],
+        }
+        for subkey, item in value.items():
+            if subkey == "id":
+                continue
+            if item is None or "unknown" in str(item):
+                continue
+            if subkey in ["isAbout", "datumType", "measureOf"]:
+                _add(node, nidm + subkey, _ref(item))
+            elif subkey in ["hasUnit"]:
+                _add(node, nidm + subkey, _literal(item))
+            elif subkey in ["label"]:
+                _add(node, RDFS + "label", _literal(item))
+            else:
+                _add(node, ants + subkey, _literal(item))
+        key_tuple = eval(key)
+        for subkey, item in key_tuple._asdict().items():
+            if item is None:
+                continue
+            if subkey == "hemi":
+                _add(node, nidm + "hasLaterality", _literal(item))
+            else:
+                _add(node, ants + subkey, _literal(item))
+        yield node
+
+
+def dump_stats_jsonld(fp, measures, subjid, add_de=False, stats_entity_id=None, data_dictionary=None):
+    """Stream a subject's NIDM document as JSON-LD to an open file
+
+    :param fp: writable text file object
+    :param measures: list of (cde id, value) tuples as returned by read_ants_stats
+    :param subjid: subject identifier
+    :param add_de: if True the definitions of the CDEs used by measures are included in the document
+    :param stats_entity_id: optional IRI of the stats collection, minted if not given
+    :param data_dictionary: optional (relative) IRI of the CDE data dictionary file
+    """
+    nodes = iter_stats_nodes(
+        measures, subjid, stats_entity_id=stats_entity_id, data_dictionary=data_dictionary
+    )
+    fp.write('{\n"@context": ')
+    json.dump(load_context(), fp)
+    fp.write(',\n"@graph": [\n')
+    for i, node in enumerate(nodes):
+        if i:
+            fp.write(",\n")
+        json.dump(node, fp)
+    if add_de:
+        for node in iter_cde_nodes(restrict_to={cde_id for cde_id, _ in measures}):
+            fp.write(",\n")
+            json.dump(node, fp)
+    fp.write("\n]\n}\n")
+
+
+def write_stats_jsonld(destination, measures, subjid, add_de=False, stats_entity_id=None, data_dictionary=None):
+    """Stream a subject's NIDM document to disk as JSON-LD
+
+    :param destination: output file path
+    :param measures: list of (cde id, value) tuples as returned by read_ants_stats
+    :param subjid: subject identifier
+    :param add_de: if True the definitions of the CDEs used by measures are included in the document
+    :param stats_entity_id: optional IRI of the stats collection, minted if not given
+    :param data_dictionary: optional (relative) IRI of the CDE data dictionary file
+    """
+    with open(destination, "w") as fp:
+        dump_stats_jsonld(
+            fp, measures, subjid, add_de=add_de, stats_entity_id=stats_entity_id,
+            data_dictionary=data_dictionary,
+        )
+
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""Local SQLite index of converted ANTS measures
+
+The converter can add each subject's measures (as returned by read_ants_stats) to an index
+together with the CDE metadata from ants-cdes.json, so measures can be looked up by subject,
+structure, hemisphere or measure without loading any NIDM files.
+"""
+
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from urllib.request import pathname2url
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS cdes (
+    cde_id TEXT PRIMARY KEY,
+    structure TEXT,
+    structure_id INTEGER,
+    hemi TEXT,
+    measure TEXT,
+    unit TEXT,
+    label TEXT,
+    isAbout TEXT
+);
+CREATE INDEX IF NOT EXISTS cdes_structure_id ON cdes (structure_id);
+CREATE INDEX IF NOT EXISTS cdes_structure ON cdes (structure COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS subjects (
+    subjid TEXT PRIMARY KEY,
+    nidm_file TEXT,
+    indexed REAL
+);
+CREATE TABLE IF NOT EXISTS measures (
+    subjid TEXT NOT NULL,
+    cde_id TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (subjid, cde_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS measures_cde_id ON measures (cde_id);
+"""
+
+COLUMNS = ["subjid", "cde_id", "structure", "structure_id", "hemi", "measure", "unit", "value"]
+
+
+def connect(db_file):
+    """Open the index, creating it if needed
+
+    :param db_file: path to the SQLite file
+    :return: sqlite3 connection
+    """
+    conn = sqlite3.connect(db_file, timeout=60)
+    # several converters may write to the same index at the same time
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def load_cdes(conn):
+    """Load the CDE metadata from ants-cdes.json unless the index already has this registry version
+
+    A different registry version replaces all CDE metadata.
+
+    :param conn: connection returned by connect
+    """
+    # not imported at module level so querying doesn't load the conversion dependencies
+    from ants_seg_to_nidm.antsutils import ANTSDKT, cde_file, get_cde_hash
+
+    registry = get_cde_hash()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'cde_hash'").fetchone()
+    if row is not None and row[0] == registry:
+        return
+
+    with open(cde_file, "r") as fp:
+        ants_cde = json.load(fp)
+
+    rows = []
+    for key, value in ants_cde.items():
+        if key == "count":
+            continue
+        key_tuple = eval(key)
+        rows.append(
+            (
+                value["id"],
+                key_tuple.structure,
+                value.get("structure_id"),
+                key_tuple.hemi,
+                key_tuple.measure,
+                key_tuple.unit,
+                value.get("label"),
+                value.get("isAbout"),
+            )
+        )
+    with conn:
+        # CDEs removed or renumbered in the new registry must not join to measures any more
+        conn.execute("DELETE FROM cdes")
+        conn.executemany("INSERT INTO cdes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('cde_hash', ?)", (registry,))
+
+
+def add_subject(db_file, subjid, measures, nidm_file=None):
+    """Add or replace one subject's measures in the index
+
+    :param db_file: path to the SQLite file
+    :param subjid: subject identifier
+    :param measures: list of (cde id, value) tuples as returned by read_ants_stats
+    :param nidm_file: optional path of the NIDM file the measures were written to
+    """
+    conn = connect(db_file)
+    try:
+        load_cdes(conn)
+        with conn:
+            conn.execute("DELETE FROM measures WHERE subjid = ?", (subjid,))
+            conn.executemany(
+                "INSERT INTO measures VALUES (?, ?, ?)",
+                [(subjid, cde_id, float(value)) for cde_id, value in measures],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO subjects VALUES (?, ?, ?)", (subjid, nidm_file, time.time())
+            )
+    finally:
+        conn.close()
+
+
+def query_measures(conn, subjids=None, structure=None, structure_id=None, hemi=None, measure=None,
+                   cde_ids=None):
+    """Look up measures in the index
+
+    All criteria are optional and combined with AND.
+    :param conn: connection returned by connect
+    :param subjids: list of subject identifiers
+    :param structure: structure name, SQL LIKE pattern matched case insensitively
+    :param structure_id: label number of the structure
+    :param hemi: hemisphere (Left or Right)
+    :param measure: measure name, e.g. Volume
+    :param cde_ids: list of CDE ids
+    :return: list of tuples with the fields in COLUMNS
+    """
+    where = []
+    params = []
+    if subjids:
+        where.append("m.subjid IN (%s)" % ",".join("?" * len(subjids)))
+        params.extend(subjids)
+    if cde_ids:
+        where.append("m.cde_id IN (%s)" % ",".join("?" * len(cde_ids)))
+        params.extend(cde_ids)
+    if structure is not None:
+        where.append("c.structure LIKE ?")
+        params.append(structure)
+    if structure_id is not None:
+        where.append("c.structure_id = ?")
+        params.append(structure_id)
+    if hemi is not None:
+        where.append("c.hemi = ? COLLATE NOCASE")
+        params.append(hemi)
+    if measure is not None:
+        where.append("c.measure = ? COLLATE NOCASE")
+        params.append(measure)
+
+    sql = (
+        "SELECT m.subjid, m.cde_id, c.structure, c.structure_id, c.hemi, c.measure, c.unit, m.value "
+        "FROM measures m JOIN cdes c ON c.cde_id = m.cde_id"
+    )
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY m.subjid, m.cde_id"
+    return conn.execute(sql, params).fetchall()
+
+
+def main():
+
+    import argparse
+    parser = argparse.ArgumentParser(prog='ants_seg_query.py',
+                                     description='''This program looks up ANTS segmentation measures in the SQLite
+                                        index maintained by ants_seg_to_nidm/antsegbatch with -index, without loading
+                                        any NIDM files. Results are written as CSV.''',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-d', '--index', dest='index', type=str, required=True,
+                        help='SQLite index file')
+    parser.add_argument('-subjid', '--subjid', dest='subjid', type=str, required=False,
+                        help='Comma separated subject identifiers')
+    parser.add_argument('-structure', '--structure', dest='structure', type=str, required=False,
+                        help='Structure name, %% and _ can be used as wildcards (e.g. %%Hippocampus%%)')
+    parser.add_argument('-structure_id', '--structure_id', dest='structure_id', type=int, required=False,
+                        help='Label number of the structure')
+    parser.add_argument('-hemi', '--hemi', dest='hemi', type=str, required=False,
+                        help='Hemisphere (Left or Right)')
+    parser.add_argument('-measure', '--measure', dest='measure', type=str, required=False,
+                        help='Measure name (e.g. Volume)')
+    parser.add_argument('-cde', '--cde', dest='cde_ids', type=str, required=False,
+                        help='Comma separated CDE ids (e.g. 000002,000003)')
+    parser.add_argument('-o', '--output', dest='output', type=str, required=False,
+                        help='Optional output CSV file, default is standard output')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.index):
+        parser.error("index %s does not exist" % args.index)
+
+    conn = sqlite3.connect("file:%s?mode=ro" % pathname2url(os.path.abspath(args.index)), uri=True)
+    try:
+        rows = query_measures(
+            conn,
+            subjids=args.subjid.split(',') if args.subjid else None,
+            structure=args.structure,
+            structure_id=args.structure_id,
+            hemi=args.hemi,
+            measure=args.measure,
+            cde_ids=args.cde_ids.split(',') if args.cde_ids else None,
+        )
+    finally:
+        conn.close()
+
+    fp = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.writer(fp)
+        writer.writerow(COLUMNS)
+        writer.writerows(rows)
+    finally:
+        if args.output:
+            fp.close()
+
+
+if __name__ == "__main__":
+    main()
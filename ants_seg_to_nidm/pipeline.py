@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""Pipelined batch conversion of ANTS segmentation outputs to NIDM
+
+Each subject of a manifest goes through fetch -> convert -> write stages connected by
+bounded queues. Fetching and writing are I/O bound and run as asyncio tasks, parsing the
+stats and building/serializing the NIDM document is CPU bound and runs in a process pool,
+so I/O for some subjects overlaps with conversion of others. The bounded queues provide
+backpressure so fast stages cannot run arbitrarily far ahead of slow ones.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, basename
+
+from ants_seg_to_nidm.antsutils import read_ants_stats, write_cde_sidecar, url_validator
+from ants_seg_to_nidm.ants_seg_to_nidm import convert_measures
+from ants_seg_to_nidm.validate import read_manifest, download
+from ants_seg_to_nidm.scheduler import MemoryScheduler, get_available_memory, MB
+from ants_seg_to_nidm.measuredb import add_subject
+
+INPUTS = ["labelstats", "brainvols", "image"]
+
+# marks the end of a stage's input
+_DONE = None
+
+
+def convert_job(labelstats, brainvol, imagefile, subjid, jsonld=False, add_de=False, data_dictionary=None):
+    """Parse one subject's stats files and serialize its NIDM document
+
+    Runs in a worker process.
+    :return: measures and serialized NIDM document
+    """
+    measures = read_ants_stats(labelstats, brainvol, imagefile)
+    return measures, convert_measures(measures, subjid, jsonld=jsonld, add_de=add_de, data_dictionary=data_dictionary)
+
+
+def _download(location, mirror, timeout):
+    # URLs are written to temporary files, paths are used as is
+    if not url_validator(location):
+        return location, None
+    temp = download(location, mirror, timeout)
+    return temp, temp
+
+
+def _cleanup(job):
+    for temp in job.pop("tempfiles", []):
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def _write(path, data):
+    with open(path, "w") as fp:
+        fp.write(data)
+
+
+async def run_stage(name, func, inbox, outbox, concurrency):
+    """Run a pipeline stage until its input is exhausted
+
+    Jobs that failed in an earlier stage are passed through untouched.
+    :param name: stage name used in error messages
+    :param func: coroutine function called with each job
+    :param inbox: queue to read jobs from
+    :param outbox: queue to pass jobs on to
+    :param concurrency: number of jobs processed at the same time
+    """
+
+    async def worker():
+        while True:
+            job = await inbox.get()
+            if job is _DONE:
+                # let the other workers of this stage see the end too
+                await inbox.put(_DONE)
+                return
+            if job["error"] is None:
+                try:
+                    await func(job)
+                except Exception as exc:
+                    job["error"] = "%s: %s" % (name, exc)
+            await outbox.put(job)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await outbox.put(_DONE)
+
+
+async def run_pipeline(rows, output_dir, jsonld=False, add_de=False, data_dictionary=None, mirror=None, timeout=10,
+                       fetch_workers=8, convert_workers=None, write_workers=4, queue_size=None, scheduler=None,
+                       index=None):
+    """Convert all subjects of a manifest
+
+    :param rows: manifest rows as returned by validate.read_manifest
+    :param output_dir: directory the <subjid>_NIDM files are written to
+    :param jsonld: if True write JSON-LD else TURTLE
+    :param add_de: if True add the definitions of the CDEs used to each file
+    :param data_dictionary: optional (relative) IRI of the CDE data dictionary file to reference
+    :param mirror: optional mirror base URL for URL inputs
+    :param timeout: timeout in seconds for URL requests
+    :param fetch_workers: number of concurrent fetches
+    :param convert_workers: number of conversion processes, defaults to the number of CPUs
+    :param write_workers: number of concurrent writes
+    :param queue_size: capacity of the queues between stages, defaults to 2 * convert_workers
+    :param scheduler: optional MemoryScheduler the conversions are run with instead of a fixed process pool
+    :param index: optional SQLite index the measures of each written subject are added to
+    :return: list of jobs with their output file or error
+    """
+    loop = asyncio.get_running_loop()
+    if convert_workers is None:
+        convert_workers = os.cpu_count() or 1
+    if queue_size is None:
+        queue_size = 2 * convert_workers
+    extension = ".json" if jsonld else ".ttl"
+
+    fetched = asyncio.Queue(maxsize=queue_size)
+    converted = asyncio.Queue(maxsize=queue_size)
+    written = asyncio.Queue()
+    source = asyncio.Queue(maxsize=queue_size)
+
+    async def do_fetch(job):
+        job["tempfiles"] = []
+        job["paths"] = []
+        try:
+            for key in INPUTS:
+                path, temp = await asyncio.to_thread(_download, job[key], mirror, timeout)
+                if temp is not None:
+                    job["tempfiles"].append(temp)
+                job["paths"].append(path)
+        except Exception:
+            _cleanup(job)
+            raise
+
+    async def do_convert(job):
+        args = (*job["paths"], job["subjid"], jsonld, add_de, data_dictionary)
+        try:
+            if scheduler is not None:
+                job["measures"], job["data"] = await scheduler.run(convert_job, *args)
+            else:
+                job["measures"], job["data"] = await loop.run_in_executor(pool, convert_job, *args)
+        finally:
+            _cleanup(job)
+
+    async def do_write(job):
+        job["output"] = join(output_dir, job["subjid"] + "_NIDM" + extension)
+        await asyncio.to_thread(_write, job["output"], job.pop("data"))
+        measures = job.pop("measures")
+        if index is not None:
+            await asyncio.to_thread(add_subject, index, job["subjid"], measures, job["output"])
+
+    async def produce():
+        for row in rows:
+            await source.put(dict(row, error=None))
+        await source.put(_DONE)
+
+    pool = ProcessPoolExecutor(max_workers=convert_workers) if scheduler is None else None
+    try:
+        await asyncio.gather(
+            produce(),
+            run_stage("fetch", do_fetch, source, fetched, fetch_workers),
+            run_stage("convert", do_convert, fetched, converted, convert_workers),
+            run_stage("write", do_write, converted, written, write_workers),
+        )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    results = []
+    while True:
+        job = written.get_nowait()
+        if job is _DONE:
+            break
+        results.append(job)
+    return results
+
+
+def main():
+
+    import argparse
+    parser = argparse.ArgumentParser(prog='ants_seg_pipeline.py',
+                                     description='''This program converts a manifest of ReproNim-style ANTS brain
+                                        segmentation outputs (CSV with columns subjid,labelstats,brainvols,image) to one
+                                        NIDM file per subject. Fetching inputs, converting and writing outputs run as
+                                        separate stages so I/O and conversion of different subjects overlap.''',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-m', '--manifest', dest='manifest', type=str, required=True,
+                        help='CSV file with columns subjid,labelstats,brainvols,image (paths or URLs)')
+    parser.add_argument('-o', '--output', dest='output_dir', type=str, required=True,
+                        help='Output directory for the <subjid>_NIDM files')
+    parser.add_argument('-j', '--jsonld', dest='jsonld', action='store_true', default = False,
+                        help='If flag set then NIDM files will be written as JSONLD instead of TURTLE')
+    parser.add_argument('-add_de', '--add_de', dest='add_de', action='store_true', default = None,
+                        help='If flag set then the data elements used by each subject will be added to its nidm file else '
+                            'the data dictionary will be written once to a separate file ants_cde_<registry hash>.ttl in '
+                            'the output directory and referenced from the nidm files')
+    parser.add_argument('-mirror', '--mirror', dest='mirror', type=str, required=False,
+                        help='Base URL of a mirror to fetch URLs from instead of their original host')
+    parser.add_argument('-timeout', '--timeout', dest='timeout', type=float, default=10,
+                        help='Timeout in seconds for URL requests')
+    parser.add_argument('-fetch_workers', '--fetch_workers', dest='fetch_workers', type=int, default=8,
+                        help='Number of subjects fetched concurrently')
+    parser.add_argument('-convert_workers', '--convert_workers', dest='convert_workers', type=int, default=None,
+                        help='Number of conversion processes (default: number of CPUs)')
+    parser.add_argument('-write_workers', '--write_workers', dest='write_workers', type=int, default=4,
+                        help='Number of output files written concurrently')
+    parser.add_argument('-queue_size', '--queue_size', dest='queue_size', type=int, default=None,
+                        help='Number of subjects buffered between stages (default: 2 x convert_workers)')
+    parser.add_argument('-max_memory', '--max_memory', dest='max_memory', type=str, required=False,
+                        help='Memory budget in MB for all conversions together, or "auto" for 80%% of the available '
+                             'memory. If set each conversion runs in its own process, concurrency (up to '
+                             'convert_workers) is adapted to the measured peak memory of the conversions and '
+                             'conversions that run out of memory are retried with fewer running alongside them')
+    parser.add_argument('-job_memory', '--job_memory', dest='job_memory', type=int, required=False,
+                        help='Initial memory estimate in MB per conversion when -max_memory is set '
+                             '(default: the first conversion runs alone to measure it)')
+    parser.add_argument('-max_retries', '--max_retries', dest='max_retries', type=int, default=2,
+                        help='Number of times a conversion that ran out of memory is retried when -max_memory is set')
+    parser.add_argument('-index', '--index', dest='index', type=str, required=False,
+                        help='Optional SQLite index the measures of each converted subject are added to for fast '
+                             'lookups with antsegquery')
+    args = parser.parse_args()
+
+    scheduler = None
+    if args.max_memory is not None:
+        if args.max_memory == 'auto':
+            available = get_available_memory()
+            if available is None:
+                parser.error("-max_memory auto: can't determine the available memory, give the budget in MB")
+            budget = int(0.8 * available)
+        else:
+            budget = int(args.max_memory) * MB
+        scheduler = MemoryScheduler(budget, args.convert_workers or os.cpu_count() or 1,
+                                    job_memory=args.job_memory * MB if args.job_memory else None,
+                                    max_retries=args.max_retries)
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    rows = read_manifest(args.manifest)
+
+    if args.add_de is None:
+        # the data dictionary is written once for all subjects
+        data_dictionary = basename(write_cde_sidecar(args.output_dir))
+    else:
+        data_dictionary = None
+
+    start = time.time()
+    results = asyncio.run(run_pipeline(rows, args.output_dir, jsonld=args.jsonld, add_de=args.add_de is not None,
+                                       data_dictionary=data_dictionary,
+                                       mirror=args.mirror, timeout=args.timeout,
+                                       fetch_workers=args.fetch_workers, convert_workers=args.convert_workers,
+                                       write_workers=args.write_workers, queue_size=args.queue_size,
+                                       scheduler=scheduler, index=args.index))
+    elapsed = time.time() - start
+
+    if scheduler is not None:
+        scheduler.shutdown()
+        for line in scheduler.report():
+            print(line)
+
+    failed = [job for job in results if job["error"] is not None]
+    for job in failed:
+        print("%s: %s" % (job["subjid"], job["error"]))
+    print("%d of %d subjects converted in %.1f s (%.2f subjects/s)"
+          % (len(results) - len(failed), len(results), elapsed, len(results) / elapsed if elapsed else 0))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""Memory-aware scheduling of conversion jobs for batch runs
+
+Every job runs in its own process so its peak RSS can be measured and an OOM kill only
+loses that job. The scheduler keeps the sum of the memory reserved for running jobs within
+a budget, where a job's reservation is the largest peak RSS recently observed, and retries
+jobs that ran out of memory with a larger reservation, i.e. with fewer jobs alongside them.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import resource
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+MB = 1024 * 1024
+
+
+def get_available_memory():
+    """Memory available for new processes in bytes, None if it can't be determined"""
+    try:
+        with open("/proc/meminfo", "r") as fp:
+            for line in fp:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_child(conn, func, args):
+    try:
+        result = func(*args)
+        status = "ok"
+    except MemoryError:
+        result = None
+        status = "oom"
+    except Exception as exc:
+        result = str(exc)
+        status = "error"
+    conn.send((status, result, _peak_rss()))
+    conn.close()
+
+
+def _get_context(preload):
+    methods = multiprocessing.get_all_start_methods()
+    if "forkserver" in methods:
+        # children are forked from a server that already imported the converter
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(list(preload))
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def run_in_process(ctx, func, args):
+    """Run func(*args) in a new process and wait for it
+
+    :return: (status, result, peak RSS in bytes) where status is "ok", "error" or "oom"
+    """
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_child, args=(child, func, args))
+    proc.start()
+    child.close()
+    try:
+        status, result, peak = parent.recv()
+    except EOFError:
+        status, result, peak = None, None, None
+    finally:
+        parent.close()
+    proc.join()
+    if status is None:
+        # killed without reporting back, SIGKILL is what the OOM killer sends
+        if proc.exitcode == -signal.SIGKILL:
+            return "oom", None, None
+        return "error", "worker exited with code %s" % proc.exitcode, None
+    return status, result, peak
+
+
+class MemoryScheduler:
+    """Run jobs in separate processes while keeping their memory within a budget
+
+    :param budget: memory budget in bytes shared by all running jobs
+    :param max_workers: maximum number of jobs running at the same time
+    :param job_memory: initial memory estimate per job in bytes, by default the first job runs alone to measure it
+    :param max_retries: number of times a job that ran out of memory is retried
+    :param window: number of recent jobs whose peak RSS sets the estimate
+    :param preload: modules imported once by the process server
+    """
+
+    def __init__(self, budget, max_workers, job_memory=None, max_retries=2, window=20,
+                 preload=("ants_seg_to_nidm.ants_seg_to_nidm",)):
+        self.budget = budget
+        self.max_workers = max_workers
+        self.initial_estimate = job_memory if job_memory is not None else budget
+        self.max_retries = max_retries
+        self.recent = deque(maxlen=window)
+        self.ctx = _get_context(preload)
+        self.threads = ThreadPoolExecutor(max_workers=max_workers)
+        self.condition = None
+        self.running = 0
+        self.reserved = 0
+        # jobs waiting to be retried after running out of memory, fresh jobs wait for them
+        self.pending_retries = 0
+
+        # statistics for the utilization report
+        self.started = None
+        self.finished = None
+        self.peaks = []
+        self.usage = 0.0
+        self.busy = 0.0
+        self.max_running = 0
+        self.oom = 0
+        self.retries = 0
+
+    def estimate(self):
+        """Current memory estimate for a job in bytes"""
+        if not self.recent:
+            return self.initial_estimate
+        # leave some headroom over the largest recent peak
+        return int(max(self.recent) * 1.1)
+
+    def _can_start(self, reservation):
+        if self.running == 0:
+            return True
+        return self.running < self.max_workers and self.reserved + reservation <= self.budget
+
+    async def run(self, func, *args):
+        """Run func(*args) in its own process once enough memory is free
+
+        :return: the return value of func
+        """
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        loop = asyncio.get_running_loop()
+        # memory reserved after running out of memory, else the current estimate is used
+        retry_reservation = None
+        attempt = 0
+        while True:
+            async with self.condition:
+                def reserve():
+                    return retry_reservation or min(self.estimate(), self.budget)
+
+                def ready():
+                    # otherwise smaller fresh jobs could keep taking the memory a retry waits for
+                    if retry_reservation is None and self.pending_retries:
+                        return False
+                    return self._can_start(reserve())
+                try:
+                    await self.condition.wait_for(ready)
+                finally:
+                    if retry_reservation is not None:
+                        self.pending_retries -= 1
+                        self.condition.notify_all()
+                reservation = reserve()
+                self.running += 1
+                self.reserved += reservation
+                self.max_running = max(self.max_running, self.running)
+            start = time.time()
+            if self.started is None:
+                self.started = start
+            try:
+                status, result, peak = await loop.run_in_executor(
+                    self.threads, run_in_process, self.ctx, func, args
+                )
+            finally:
+                async with self.condition:
+                    self.running -= 1
+                    self.reserved -= reservation
+                    self.condition.notify_all()
+            end = time.time()
+            self.finished = end
+            self.busy += end - start
+            if peak is not None:
+                self.recent.append(peak)
+                self.peaks.append(peak)
+                self.usage += peak * (end - start)
+
+            if status == "ok":
+                return result
+            if status == "error":
+                raise RuntimeError(result)
+
+            self.oom += 1
+            if attempt >= self.max_retries or reservation >= self.budget:
+                raise MemoryError("out of memory after %d attempts" % (attempt + 1))
+            # retry with fewer jobs alongside this one
+            attempt += 1
+            self.retries += 1
+            self.pending_retries += 1
+            retry_reservation = min(2 * max(reservation, self.estimate()), self.budget)
+
+    def shutdown(self):
+        self.threads.shutdown()
+
+    def report(self):
+        """Summary of memory use and concurrency
+
+        :return: list of lines
+        """
+        lines = ["memory budget: %.0f MB, max workers: %d" % (self.budget / MB, self.max_workers)]
+        if self.peaks:
+            lines.append(
+                "peak RSS per job: mean %.0f MB, max %.0f MB"
+                % (sum(self.peaks) / len(self.peaks) / MB, max(self.peaks) / MB)
+            )
+        if self.started is not None and self.finished > self.started:
+            wall = self.finished - self.started
+            lines.append(
+                "concurrency: mean %.1f, max %d" % (self.busy / wall, self.max_running)
+            )
+            lines.append(
+                "memory utilization: %.0f%% of budget" % (100 * self.usage / (self.budget * wall))
+            )
+        lines.append("out of memory: %d, retried: %d" % (self.oom, self.retries))
+        return lines
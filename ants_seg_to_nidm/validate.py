@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+"""Preflight validation of ANTS segmentation inputs before conversion to NIDM
+
+Checks a manifest of labelstats/brainvols/image triples against the CDE registry
+without building any RDF so bad inputs can be excluded before running ants_seg_to_nidm.
+"""
+
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import urllib.request as ur
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import urlparse
+
+import nibabel as nib
+from nibabel.freesurfer.mghformat import MGHHeader
+import numpy as np
+import pandas as pd
+
+from ants_seg_to_nidm.antsutils import (
+    SLAB_BYTES,
+    cde_file,
+    check_label_volumes,
+    get_brainvols_key,
+    get_id_to_struct,
+    get_labelstats_keys,
+    url_validator,
+)
+
+MANIFEST_COLUMNS = ["subjid", "labelstats", "brainvols", "image"]
+
+# optional manifest column with the label image the labelstats were computed from, the image column is
+# only used for voxel sizes and usually is a tissue segmentation with different labels
+LABELS_COLUMN = "labels"
+
+# enough of a (compressed) image to decode its header, at most 540 bytes for NIfTI-2
+HEADER_BYTES = 65536
+
+# header classes by the first int32 of the file (sizeof_hdr for NIfTI, version for MGH)
+HEADER_CLASSES = [
+    ("<i4", 348, nib.Nifti1Header),
+    (">i4", 348, nib.Nifti1Header),
+    ("<i4", 540, nib.Nifti2Header),
+    (">i4", 540, nib.Nifti2Header),
+    (">i4", 1, MGHHeader),
+]
+
+
+lookup_structure = lru_cache(maxsize=None)(get_id_to_struct)
+
+
+def read_manifest(manifest_file):
+    """Read a manifest of subjects to validate
+
+    :param manifest_file: CSV file with columns subjid,labelstats,brainvols,image where the last three
+        are paths or URLs as given to ants_seg_to_nidm -f, and optionally labels with the path or URL of
+        the label image the labelstats were computed from
+    :return: list of dictionaries, one per subject
+    """
+    with open(manifest_file, "r", newline="") as fp:
+        rows = list(csv.DictReader(fp))
+    if rows:
+        missing = [c for c in MANIFEST_COLUMNS if c not in rows[0]]
+        if missing:
+            raise ValueError(f"Manifest {manifest_file} is missing columns: {', '.join(missing)}")
+    return rows
+
+
+def mirror_url(url, mirror=None):
+    """Rewrite a URL to point at a mirror
+
+    :param url: original URL
+    :param mirror: base URL of the mirror, the original path is appended to it
+    :return: URL to fetch
+    """
+    if mirror is None:
+        return url
+    src = urlparse(url)
+    dst = urlparse(mirror)
+    return src._replace(
+        scheme=dst.scheme, netloc=dst.netloc, path=dst.path.rstrip("/") + src.path
+    ).geturl()
+
+
+def url_suffix(url):
+    """File extensions of a URL's path, e.g. .nii.gz, so nibabel can recognize downloaded images
+
+    :param url: URL
+    :return: suffixes of the last path component, empty string if there are none
+    """
+    return "".join(Path(urlparse(url).path).suffixes)
+
+
+def fetch(location, mirror=None, timeout=10, nbytes=None):
+    """Read a local file or URL
+
+    :param location: path or URL
+    :param mirror: optional mirror base URL used for URLs
+    :param timeout: timeout in seconds for URL requests
+    :param nbytes: optional number of leading bytes to read
+    :return: file contents as bytes
+    """
+    if url_validator(location):
+        request = ur.Request(mirror_url(location, mirror))
+        if nbytes is not None:
+            request.add_header("Range", f"bytes=0-{nbytes - 1}")
+        with ur.urlopen(request, timeout=timeout) as opener:
+            return opener.read() if nbytes is None else opener.read(nbytes)
+    with open(location, "rb") as fp:
+        return fp.read() if nbytes is None else fp.read(nbytes)
+
+
+def download(url, mirror=None, timeout=10):
+    """Stream a URL to a temporary file without holding its contents in memory
+
+    :param url: URL to download
+    :param mirror: optional mirror base URL
+    :param timeout: timeout in seconds for the request
+    :return: path of the temporary file, which keeps the URL's extensions, to be removed by the caller
+    """
+    fp = tempfile.NamedTemporaryFile(delete=False, suffix=url_suffix(url))
+    try:
+        with fp, ur.urlopen(mirror_url(url, mirror), timeout=timeout) as opener:
+            shutil.copyfileobj(opener, fp)
+    except Exception:
+        os.remove(fp.name)
+        raise
+    return fp.name
+
+
+def read_voxel_size(raw):
+    """Get voxel sizes from the leading bytes of an image
+
+    NIfTI-1, NIfTI-2 and MGH images are recognized from their first 4 bytes.
+    :param raw: leading bytes of a .nii, .nii.gz, .mgh or .mgz file
+    :return: tuple of voxel sizes
+    """
+    if raw[:2] == b"\x1f\x8b":
+        # decompress only what is available, the image data is never needed
+        raw = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(raw)
+    if len(raw) >= 4:
+        for dtype, value, header_class in HEADER_CLASSES:
+            if np.frombuffer(raw[:4], dtype=dtype)[0] == value:
+                size = header_class.template_dtype.itemsize
+                if len(raw) < size:
+                    raise ValueError(f"truncated {header_class.__name__}")
+                header = header_class(binaryblock=raw[:size], check=False)
+                return header.get_zooms()[:3]
+    raise ValueError("unsupported image format, expected NIfTI-1, NIfTI-2 or MGH")
+
+
+def check_volumes(labelstats, labels, mirror=None, timeout=10, max_bytes=SLAB_BYTES):
+    """Compare VolumeInVoxels of a labelstats file with the voxels of each label in the label image
+
+    The image is read slab by slab, URLs are streamed to a temporary file first.
+    :param labelstats: contents of the labelstats file as bytes
+    :param labels: path or URL of the label image the labelstats were computed from
+    :param mirror: optional mirror base URL
+    :param timeout: timeout in seconds for URL requests
+    :param max_bytes: maximum size in bytes of the image slabs read at once
+    :return: list of error messages
+    """
+    temp = download(labels, mirror, timeout) if url_validator(labels) else None
+    try:
+        mismatches = check_label_volumes(BytesIO(labelstats), temp or labels, max_bytes=max_bytes)
+    finally:
+        if temp is not None:
+            os.remove(temp)
+    return [
+        f"label {label:d} has VolumeInVoxels {voxels:d} but {image_voxels:d} voxels in the label image"
+        for label, voxels, image_voxels in mismatches
+    ]
+
+
+def check_labelstats(ants_stats, ants_cde):
+    """Check a labelstats table the way read_ants_stats reads it
+
+    :param ants_stats: labelstats file as pandas dataframe
+    :param ants_cde: CDE registry as loaded from ants-cdes.json
+    :return: list of error messages
+    """
+    errors = []
+    for column in ["Label", "VolumeInVoxels"]:
+        if column not in ants_stats.columns:
+            errors.append(f"labelstats is missing column {column}")
+    if "Label" not in ants_stats.columns:
+        return errors
+
+    segids = pd.to_numeric(ants_stats["Label"], errors="coerce")
+    bad = ants_stats["Label"][segids.isna()]
+    if len(bad):
+        errors.append(f"labelstats has {len(bad)} rows with a missing or non-numeric Label ({bad.iloc[0]!r})")
+    for segid in segids.dropna().unique():
+        structure = lookup_structure(int(segid))
+        if structure is None:
+            errors.append(f"label {int(segid):d} did not return any structure")
+            continue
+        for key in ants_stats.columns:
+            for key_tuple in get_labelstats_keys(key, structure):
+                if str(key_tuple) not in ants_cde:
+                    errors.append(f"Key {key_tuple} not found in ANTS data elements file")
+    return errors
+
+
+def validate_subject(row, ants_cde, mirror=None, timeout=10, volumes=False, max_bytes=SLAB_BYTES):
+    """Check one subject's inputs
+
+    :param row: manifest row with subjid, labelstats, brainvols, image and optionally labels
+    :param ants_cde: CDE registry as loaded from ants-cdes.json
+    :param mirror: optional mirror base URL
+    :param timeout: timeout in seconds for URL requests
+    :param volumes: if True also compare VolumeInVoxels of the labelstats with the labels image, if the row has one
+    :param max_bytes: maximum size in bytes of the image slabs read at once when volumes is True
+    :return: list of error messages, empty if the subject can be converted
+    """
+    errors = []
+    labelstats = None
+
+    # parse failures are reported for the subject instead of aborting the whole manifest
+    try:
+        brain_vols = pd.read_csv(BytesIO(fetch(row["brainvols"], mirror, timeout)))
+        for key in brain_vols.columns:
+            if str(get_brainvols_key(key)) not in ants_cde:
+                errors.append(f"brainvols column {key} not found in ANTS data elements file")
+        if len(brain_vols) != 1:
+            errors.append(f"brainvols has {len(brain_vols)} rows, expected 1")
+    except Exception as exc:
+        errors.append(f"brainvols {row['brainvols']}: {exc}")
+
+    try:
+        labelstats = fetch(row["labelstats"], mirror, timeout)
+        ants_stats = pd.read_csv(BytesIO(labelstats))
+        errors.extend(check_labelstats(ants_stats, ants_cde))
+    except Exception as exc:
+        errors.append(f"labelstats {row['labelstats']}: {exc}")
+
+    try:
+        zooms = read_voxel_size(fetch(row["image"], mirror, timeout, nbytes=HEADER_BYTES))
+    except Exception as exc:
+        errors.append(f"image {row['image']}: {exc}")
+    else:
+        if len(zooms) != 3 or not all(z > 0 for z in zooms):
+            errors.append(f"image has invalid voxel sizes {zooms}")
+
+    if volumes and not errors and row.get(LABELS_COLUMN):
+        try:
+            errors.extend(check_volumes(labelstats, row[LABELS_COLUMN], mirror, timeout, max_bytes=max_bytes))
+        except Exception as exc:
+            errors.append(f"labels {row[LABELS_COLUMN]}: {exc}")
+
+    return errors
+
+
+def validate_manifest(rows, mirror=None, timeout=10, nproc=8, volumes=False, max_bytes=SLAB_BYTES):
+    """Check all subjects of a manifest in parallel
+
+    :param rows: manifest rows as returned by read_manifest
+    :param mirror: optional mirror base URL
+    :param timeout: timeout in seconds for URL requests
+    :param nproc: number of subjects checked concurrently
+    :param volumes: if True also compare VolumeInVoxels of the labelstats with the labels images
+    :param max_bytes: maximum size in bytes of the image slabs read at once when volumes is True
+    :return: list of (subjid, errors) tuples in manifest order
+    """
+    with open(cde_file, "r") as fp:
+        ants_cde = json.load(fp)
+
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        results = pool.map(
+            lambda row: validate_subject(
+                row, ants_cde, mirror=mirror, timeout=timeout, volumes=volumes, max_bytes=max_bytes
+            ),
+            rows,
+        )
+        return [(row["subjid"], errors) for row, errors in zip(rows, results)]
+
+
+def write_report(results, report_file):
+    """Write validation results as CSV with one row per subject
+
+    :param results: list of (subjid, errors) tuples
+    :param report_file: output CSV file
+    """
+    with open(report_file, "w", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(["subjid", "valid", "errors"])
+        for subjid, errors in results:
+            writer.writerow([subjid, not errors, "; ".join(errors)])
+
+
+def main():
+
+    import argparse
+    parser = argparse.ArgumentParser(prog='ants_seg_validate.py',
+                                     description='''This program checks a manifest of ReproNim-style ANTS brain
+                                        segmentation outputs (CSV with columns subjid,labelstats,brainvols,image) against
+                                        the ANTS common data elements without converting them to NIDM, so subjects that
+                                        would fail can be excluded before running ants_seg_to_nidm.''',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-m', '--manifest', dest='manifest', type=str, required=True,
+                        help='CSV file with columns subjid,labelstats,brainvols,image (paths or URLs)')
+    parser.add_argument('-o', '--output', dest='report', type=str, required=False,
+                        help='Optional CSV report with columns subjid,valid,errors')
+    parser.add_argument('-mirror', '--mirror', dest='mirror', type=str, required=False,
+                        help='Base URL of a mirror to check URLs against instead of their original host')
+    parser.add_argument('-timeout', '--timeout', dest='timeout', type=float, default=10,
+                        help='Timeout in seconds for URL requests')
+    parser.add_argument('-nproc', '--nproc', dest='nproc', type=int, default=8,
+                        help='Number of subjects checked in parallel')
+    parser.add_argument('-check_volumes', '--check_volumes', dest='volumes', action='store_true', default=False,
+                        help='If flag set then VolumeInVoxels of each labelstats file is compared with the number of '
+                             'voxels of each label in the label image given in the optional manifest column labels. '
+                             'Subjects without a labels image are not checked. Images are read in slabs so memory use '
+                             'is bounded by nproc x slab_mb, URL images are streamed to temporary files')
+    parser.add_argument('-slab_mb', '--slab_mb', dest='slab_mb', type=int, default=SLAB_BYTES // (1024 * 1024),
+                        help='Maximum size in MB of the image slabs read at once with -check_volumes')
+    args = parser.parse_args()
+
+    rows = read_manifest(args.manifest)
+    results = validate_manifest(rows, mirror=args.mirror,
+                                timeout=args.timeout, nproc=args.nproc,
+                                volumes=args.volumes, max_bytes=args.slab_mb * 1024 * 1024)
+
+    if args.volumes:
+        unchecked = sum(1 for row in rows if not row.get(LABELS_COLUMN))
+        if unchecked:
+            print("%d subjects have no %s image, VolumeInVoxels not checked" % (unchecked, LABELS_COLUMN))
+
+    invalid = 0
+    for subjid, errors in results:
+        if errors:
+            invalid += 1
+            for error in errors:
+                print("%s: %s" % (subjid, error))
+    print("%d of %d subjects passed validation" % (len(results) - invalid, len(results)))
+
+    if args.report is not None:
+        write_report(results, args.report)
+
+    if invalid:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -52,7 +52,10 @@ setup(
         ]},
     entry_points={
         'console_scripts': [
-            'antsegstats2nidm=ants_seg_to_nidm.ants_seg_to_nidm:main' # this is where the console entry points are defined
+            'antsegstats2nidm=ants_seg_to_nidm.ants_seg_to_nidm:main', # this is where the console entry points are defined
+            'antsegvalidate=ants_seg_to_nidm.validate:main',
+            'antsegbatch=ants_seg_to_nidm.pipeline:main',
+            'antsegquery=ants_seg_to_nidm.measuredb:main',
             ],
     },
     classifiers=[
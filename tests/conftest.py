@@ -0,0 +1,70 @@
+import tempfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="session")
+def examples():
+    """Directory with the example subject"""
+    return Path(__file__).parent.parent / "examples"
+
+
+@pytest.fixture(scope="session")
+def example_inputs(examples):
+    """labelstats, brainvols and image of the example subject as in a manifest row"""
+    return {
+        "labelstats": str(examples / "antslabelstats.csv"),
+        "brainvols": str(examples / "antsbrainvols.csv"),
+        "image": str(examples / "antsBrainSegmentation.nii.gz"),
+    }
+
+
+def _make_label_image(ants_stats, shape=(64, 64), dtype=np.uint16):
+    data = np.repeat(ants_stats["Label"].to_numpy(), ants_stats["VolumeInVoxels"].to_numpy())
+    plane = shape[0] * shape[1]
+    data = np.concatenate([data, np.zeros(-len(data) % plane, dtype=data.dtype)])
+    np.random.default_rng(0).shuffle(data)
+    data = data.reshape(shape + (-1,), order="F").astype(dtype)
+    return nib.Nifti1Image(data, np.diag([0.5, 0.5, 0.5, 1]), dtype=dtype)
+
+
+@pytest.fixture(scope="session")
+def make_label_image():
+    """Function creating a label image with VolumeInVoxels voxels of each label of a labelstats table"""
+    return _make_label_image
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """Serve a temporary directory over HTTP
+
+    :return: (directory, base URL)
+    """
+    root = tmp_path / "www"
+    root.mkdir()
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), partial(_QuietHandler, directory=str(root)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield root, "http://127.0.0.1:%d/" % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def tempdir(tmp_path, monkeypatch):
+    """Private directory for temporary files so leftovers can be detected"""
+    path = tmp_path / "tmp"
+    path.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(path))
+    return path
@@ -0,0 +1,82 @@
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+from ants_seg_to_nidm.antsutils import (
+    check_label_volumes,
+    count_label_voxels,
+    get_label_volumes,
+    iter_image_slabs,
+    read_ants_stats,
+)
+
+def expected_counts(data):
+    labels, counts = np.unique(data, return_counts=True)
+    return dict(zip(labels.tolist(), counts.tolist()))
+
+
+@pytest.fixture(scope="module")
+def ants_stats(example_inputs):
+    return pd.read_csv(example_inputs["labelstats"])
+
+
+@pytest.mark.parametrize("extension", [".nii", ".nii.gz"])
+@pytest.mark.parametrize("nproc", [1, 3])
+def test_count_label_voxels_files(tmp_path, ants_stats, make_label_image, extension, nproc):
+    img = make_label_image(ants_stats)
+    path = str(tmp_path / ("labels" + extension))
+    img.to_filename(path)
+    max_bytes = 10 * 64 * 64 * 2
+    assert all(slab.nbytes <= max_bytes for _, slab in iter_image_slabs(path, max_bytes=max_bytes))
+    counts = count_label_voxels(path, max_bytes=max_bytes, nproc=nproc)
+    assert counts == expected_counts(img.get_fdata())
+
+
+def test_count_label_voxels_uint64(tmp_path, ants_stats, make_label_image):
+    img = make_label_image(ants_stats, dtype=np.uint64)
+    path = str(tmp_path / "labels.nii")
+    img.to_filename(path)
+    assert count_label_voxels(path) == expected_counts(np.asanyarray(img.dataobj))
+
+
+def test_iter_image_slabs_fallback_4d():
+    # in memory images are not an on-disk ArrayProxy
+    data = np.arange(6 * 5 * 4 * 3, dtype=np.int16).reshape((6, 5, 4, 3)) % 7
+    img = nib.Nifti1Image(data, np.eye(4))
+    max_bytes = 2 * 6 * 5 * 2
+    slabs = list(iter_image_slabs(img, max_bytes=max_bytes))
+    assert all(slab.nbytes <= max_bytes for _, slab in slabs)
+    assert [start for start, _ in slabs] == list(range(0, 12, 2))
+    flat = data.reshape((6, 5, 12), order="F")
+    for start, slab in slabs:
+        assert np.array_equal(slab, flat[:, :, start : start + slab.shape[2]])
+    assert count_label_voxels(img, max_bytes=max_bytes) == expected_counts(data)
+
+
+def test_check_label_volumes_consistent(tmp_path, ants_stats, make_label_image, example_inputs):
+    path = str(tmp_path / "labels.nii.gz")
+    make_label_image(ants_stats).to_filename(path)
+    assert check_label_volumes(example_inputs["labelstats"], path, max_bytes=2 ** 16, nproc=2) == []
+    volumes = get_label_volumes(path)
+    label = int(ants_stats["Label"][0])
+    assert volumes[label] == pytest.approx(ants_stats["VolumeInVoxels"][0] * 0.125)
+
+
+def test_check_label_volumes_mismatch(tmp_path, ants_stats, make_label_image, example_inputs):
+    changed = ants_stats.copy()
+    changed.loc[0, "VolumeInVoxels"] -= 1
+    path = str(tmp_path / "labels.nii.gz")
+    make_label_image(changed).to_filename(path)
+    label = int(ants_stats["Label"][0])
+    voxels = int(ants_stats["VolumeInVoxels"][0])
+    assert check_label_volumes(example_inputs["labelstats"], path) == [(label, voxels, voxels - 1)]
+
+
+def test_read_ants_stats_label_column_order(tmp_path, ants_stats, example_inputs):
+    labelstats = tmp_path / "antslabelstats.csv"
+    ants_stats[list(ants_stats.columns[1:]) + ["Label"]].to_csv(labelstats, index=False)
+    brainvols, image = example_inputs["brainvols"], example_inputs["image"]
+    assert read_ants_stats(str(labelstats), brainvols, image) == read_ants_stats(
+        example_inputs["labelstats"], brainvols, image
+    )
@@ -0,0 +1,68 @@
+from io import StringIO
+
+import pytest
+import rdflib as rl
+from rdflib.compare import isomorphic
+from nidm.core import Constants
+
+from ants_seg_to_nidm.antsutils import read_ants_stats
+from ants_seg_to_nidm.ants_seg_to_nidm import convert_measures
+from ants_seg_to_nidm.jsonldutils import compact_iri, dump_stats_jsonld
+
+# relative data dictionary references are resolved against this base in both graphs
+BASE = "file:///data/"
+
+
+@pytest.fixture(scope="module")
+def measures(example_inputs):
+    return read_ants_stats(example_inputs["labelstats"], example_inputs["brainvols"], example_inputs["image"])
+
+
+def anonymize(graph):
+    # the niiri identifiers are minted independently by the two code paths, compare them as blank nodes
+    niiri = str(Constants.NIIRI)
+    bnodes = {}
+
+    def term(t):
+        if isinstance(t, rl.URIRef) and t.startswith(niiri):
+            return bnodes.setdefault(t, rl.BNode())
+        return t
+
+    g = rl.Graph()
+    for s, p, o in graph:
+        g.add((term(s), p, term(o)))
+    return g
+
+
+def jsonld_graph(measures, **kwargs):
+    fp = StringIO()
+    dump_stats_jsonld(fp, measures, "0050002", **kwargs)
+    return rl.Graph().parse(data=fp.getvalue(), format="json-ld", publicID=BASE)
+
+
+def turtle_graph(measures, **kwargs):
+    data = convert_measures(measures, "0050002", **kwargs)
+    return rl.Graph().parse(data=data, format="turtle", publicID=BASE)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{}, {"add_de": True}, {"data_dictionary": "ants_cde_0123456789ab.ttl"}],
+    ids=["plain", "add_de", "data_dictionary"],
+)
+def test_jsonld_isomorphic_to_rdflib(measures, kwargs):
+    emitted = jsonld_graph(measures, **kwargs)
+    expected = turtle_graph(measures, **kwargs)
+    assert len(emitted) == len(expected)
+    assert isomorphic(anonymize(emitted), anonymize(expected))
+
+
+def test_jsonld_detects_changed_value(measures):
+    changed = [(cde_id, "1" if i == 0 else value) for i, (cde_id, value) in enumerate(measures)]
+    assert not isomorphic(anonymize(jsonld_graph(changed)), anonymize(turtle_graph(measures)))
+
+
+def test_compact_iri():
+    assert compact_iri("http://uri.interlex.org/base/ilx_0738276") == "ilx:0738276"
+    assert compact_iri("http://stnava.github.io/ANTs/ants_000001") == "ants:ants_000001"
+    assert compact_iri("http://example.org/x") == "http://example.org/x"
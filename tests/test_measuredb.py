@@ -0,0 +1,23 @@
+from ants_seg_to_nidm.measuredb import add_subject, connect, load_cdes, query_measures
+
+
+def test_add_and_query(tmp_path):
+    index = str(tmp_path / "index.db")
+    add_subject(index, "s1", [("000002", "1.5"), ("000003", "2")], nidm_file="s1_NIDM.ttl")
+    add_subject(index, "s1", [("000002", "3")])
+    conn = connect(index)
+    rows = query_measures(conn, subjids=["s1"])
+    assert [(row[0], row[1], row[-1]) for row in rows] == [("s1", "000002", 3.0)]
+
+
+def test_registry_change_drops_stale_cdes(tmp_path):
+    index = str(tmp_path / "index.db")
+    add_subject(index, "s1", [("000002", "1.5")])
+    conn = connect(index)
+    with conn:
+        conn.execute("INSERT INTO cdes (cde_id, structure) VALUES ('999999', 'Removed')")
+        conn.execute("INSERT INTO measures VALUES ('s1', '999999', 1.0)")
+        conn.execute("UPDATE meta SET value = 'old' WHERE key = 'cde_hash'")
+    load_cdes(conn)
+    assert conn.execute("SELECT * FROM cdes WHERE cde_id = '999999'").fetchall() == []
+    assert [row[1] for row in query_measures(conn, subjids=["s1"])] == ["000002"]
@@ -0,0 +1,88 @@
+import asyncio
+import gzip
+import shutil
+
+import pytest
+
+from ants_seg_to_nidm.pipeline import _DONE, run_pipeline, run_stage
+
+
+@pytest.fixture
+def server(http_server, example_inputs):
+    """Serve the example inputs over HTTP, with the image uncompressed and a malformed labelstats"""
+    root, url = http_server
+    shutil.copy(example_inputs["labelstats"], root)
+    shutil.copy(example_inputs["brainvols"], root)
+    with gzip.open(example_inputs["image"]) as src, open(root / "seg.nii", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    (root / "bad_labelstats.csv").write_text("Label,VolumeInVoxels\n,5\n")
+    return url
+
+
+def test_run_pipeline(server, tempdir, tmp_path, example_inputs):
+    good = {
+        "labelstats": server + "antslabelstats.csv",
+        "brainvols": server + "antsbrainvols.csv",
+        "image": server + "seg.nii",
+    }
+    rows = [dict(good, subjid="s%d" % i) for i in range(4)]
+    rows.insert(1, dict(good, subjid="missing", labelstats=server + "nothere.csv"))
+    rows.insert(3, dict(good, subjid="malformed", labelstats=server + "bad_labelstats.csv"))
+    rows.append(dict(example_inputs, subjid="local"))
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+
+    results = asyncio.run(
+        asyncio.wait_for(
+            run_pipeline(rows, str(output_dir), fetch_workers=3, convert_workers=2, write_workers=2, queue_size=1),
+            timeout=120,
+        )
+    )
+
+    errors = {job["subjid"]: job["error"] for job in results}
+    assert sorted(errors) == sorted(row["subjid"] for row in rows)
+    assert errors["missing"].startswith("fetch: ")
+    assert errors["malformed"].startswith("convert: ")
+    good_subjects = ["s0", "s1", "s2", "s3", "local"]
+    assert all(errors[subjid] is None for subjid in good_subjects)
+    assert sorted(p.name for p in output_dir.iterdir()) == sorted(s + "_NIDM.ttl" for s in good_subjects)
+    assert list(tempdir.iterdir()) == []
+
+
+def test_run_stage_backpressure_and_errors():
+    counts = {"a": 0, "b": 0, "ahead": 0}
+
+    async def stage_a(job):
+        if job["n"] == 3:
+            raise ValueError("bad job")
+        counts["a"] += 1
+        counts["ahead"] = max(counts["ahead"], counts["a"] - counts["b"])
+
+    async def stage_b(job):
+        counts["b"] += 1
+        await asyncio.sleep(0.01)
+
+    async def run():
+        source = asyncio.Queue()
+        middle = asyncio.Queue(maxsize=1)
+        done = asyncio.Queue()
+        for n in range(20):
+            source.put_nowait({"n": n, "error": None})
+        source.put_nowait(_DONE)
+        await asyncio.gather(
+            run_stage("a", stage_a, source, middle, 2),
+            run_stage("b", stage_b, middle, done, 1),
+        )
+        jobs = []
+        while True:
+            job = done.get_nowait()
+            if job is _DONE:
+                return jobs
+            jobs.append(job)
+
+    jobs = asyncio.run(asyncio.wait_for(run(), timeout=30))
+    assert sorted(job["n"] for job in jobs) == list(range(20))
+    assert [job["error"] for job in jobs if job["error"]] == ["a: bad job"]
+    assert counts["b"] == 19
+    # 2 workers of stage a blocked on put, 1 job in the queue and 1 taken by stage b but not started yet
+    assert counts["ahead"] <= 4
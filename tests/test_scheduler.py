@@ -0,0 +1,118 @@
+import asyncio
+import os
+import signal
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from ants_seg_to_nidm import scheduler
+from ants_seg_to_nidm.scheduler import MB, MemoryScheduler
+
+
+# jobs run in separate processes so they have to be importable module level functions
+def sleep_job(seconds):
+    start = time.time()
+    time.sleep(seconds)
+    return start, time.time()
+
+
+def memory_error_job():
+    raise MemoryError
+
+
+def killed_job():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def failing_job():
+    raise ValueError("bad input")
+
+
+def max_overlap(intervals):
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    running = overlap = 0
+    for _, change in events:
+        running += change
+        overlap = max(overlap, running)
+    return overlap
+
+
+def run_jobs(sched, func, *args_list):
+    async def run():
+        return await asyncio.gather(*(sched.run(func, *args) for args in args_list))
+
+    try:
+        return asyncio.run(run())
+    finally:
+        sched.shutdown()
+
+
+@pytest.mark.parametrize(
+    "func,peaks",
+    [(memory_error_job, 3), (killed_job, 0)],
+    ids=["MemoryError", "SIGKILL"],
+)
+def test_out_of_memory_retried(func, peaks):
+    sched = MemoryScheduler(1024 * MB, 2, job_memory=10 * MB, max_retries=2, preload=())
+    with pytest.raises(MemoryError, match="after 3 attempts"):
+        run_jobs(sched, func, ())
+    assert (sched.oom, sched.retries) == (3, 2)
+    assert len(sched.peaks) == peaks
+    assert sched.report()[-1] == "out of memory: 3, retried: 2"
+
+
+def test_error_not_retried():
+    sched = MemoryScheduler(1024 * MB, 2, job_memory=10 * MB, preload=())
+    with pytest.raises(RuntimeError, match="bad input"):
+        run_jobs(sched, failing_job, ())
+    assert (sched.oom, sched.retries) == (0, 0)
+
+
+def test_max_workers():
+    sched = MemoryScheduler(64 * 1024 * MB, 2, job_memory=MB, preload=())
+    intervals = run_jobs(sched, sleep_job, *[(0.3,)] * 6)
+    assert max_overlap(intervals) == 2
+    assert sched.max_running == 2
+    assert len(sched.peaks) == 6
+    assert sched.report()[-1] == "out of memory: 0, retried: 0"
+
+
+def test_memory_budget():
+    # measure the peak RSS of a job to size the budget for two of them
+    calibration = MemoryScheduler(64 * 1024 * MB, 1, preload=())
+    run_jobs(calibration, sleep_job, (0,))
+    budget = int(2.5 * calibration.estimate())
+
+    sched = MemoryScheduler(budget, 6, preload=())
+    intervals = run_jobs(sched, sleep_job, *[(0.3,)] * 6)
+    assert max_overlap(intervals) <= 2
+    assert sched.max_running <= 2
+    # without job_memory the first job runs alone to measure it
+    first, *others = sorted(intervals)
+    assert all(start >= first[1] for start, _ in others)
+
+
+def test_retry_has_priority(monkeypatch):
+    starts = []
+    attempts = Counter()
+    lock = threading.Lock()
+
+    def fake_run_in_process(ctx, func, args):
+        name, seconds = args
+        with lock:
+            attempts[name] += 1
+            starts.append(name)
+        time.sleep(seconds)
+        if name == "big" and attempts[name] == 1:
+            return "oom", None, None
+        return "ok", name, 30 * MB
+
+    monkeypatch.setattr(scheduler, "run_in_process", fake_run_in_process)
+    sched = MemoryScheduler(100 * MB, 4, job_memory=30 * MB, preload=())
+    jobs = [("big", 0.02)] + [("job%d" % i, 0.05 + 0.01 * (i % 3)) for i in range(15)]
+    run_jobs(sched, None, *jobs)
+    retry = [i for i, name in enumerate(starts) if name == "big"][1]
+    # the retry doesn't wait for all fresh jobs to get in ahead of it
+    assert retry < len(starts) - 5
@@ -0,0 +1,66 @@
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import rdflib as rl
+
+from ants_seg_to_nidm import antsutils
+from ants_seg_to_nidm.antsutils import get_cde_sidecar_name, write_cde_sidecar
+from ants_seg_to_nidm.ants_seg_to_nidm import main
+
+
+def test_write_cde_sidecar_once(tmp_path):
+    path = write_cde_sidecar(str(tmp_path))
+    assert Path(path) == tmp_path / get_cde_sidecar_name()
+    assert len(rl.Graph().parse(path, format="turtle")) > 0
+    assert [p.name for p in tmp_path.iterdir()] == [get_cde_sidecar_name()]
+
+    # an existing data dictionary is never rewritten
+    Path(path).write_text("# existing\n")
+    assert write_cde_sidecar(str(tmp_path)) == path
+    assert Path(path).read_text() == "# existing\n"
+
+
+def test_sidecar_name_follows_registry(tmp_path, monkeypatch):
+    name = get_cde_sidecar_name()
+    assert name.startswith("ants_cde_") and name.endswith(".ttl")
+    registry = tmp_path / "ants-cdes.json"
+    shutil.copy(antsutils.cde_file, registry)
+    monkeypatch.setattr(antsutils, "cde_file", registry)
+    assert get_cde_sidecar_name() == name
+    with open(registry, "a") as fp:
+        fp.write("\n")
+    assert get_cde_sidecar_name() != name
+
+
+def run_main(monkeypatch, inputs, *args):
+    stats = ",".join([inputs["labelstats"], inputs["brainvols"], inputs["image"]])
+    monkeypatch.setattr(sys, "argv", ["antsegstats2nidm", "-f", stats, "-subjid", "0050002", *args])
+    main()
+
+
+def see_also(nidm_file):
+    g = rl.Graph().parse(str(nidm_file), format="turtle")
+    return [str(o) for o in g.objects(predicate=rl.RDFS.seeAlso)]
+
+
+def test_reference_new_file(tmp_path, monkeypatch, example_inputs):
+    output = tmp_path / "out" / "0050002_NIDM.ttl"
+    run_main(monkeypatch, example_inputs, "-o", str(output))
+    name = get_cde_sidecar_name()
+    assert (tmp_path / "out" / name).exists()
+    assert "<%s>" % name in output.read_text()
+    assert see_also(output) == [(tmp_path / "out" / name).as_uri()]
+
+
+def test_reference_augmented_file_in_other_directory(tmp_path, monkeypatch, examples, example_inputs):
+    nidm_file = tmp_path / "nidm" / "nidm.ttl"
+    nidm_file.parent.mkdir()
+    shutil.copy(examples / "0050002_NIDM.ttl", nidm_file)
+    output = tmp_path / "out" / "0050002_NIDM.ttl"
+    run_main(monkeypatch, example_inputs, "-o", str(output), "-n", str(nidm_file), "-forcenidm")
+    name = get_cde_sidecar_name()
+    assert sorted(os.listdir(tmp_path / "out")) == [name]
+    assert "<../out/%s>" % name in nidm_file.read_text()
+    assert see_also(nidm_file) == [(tmp_path / "out" / name).as_uri()]
@@ -0,0 +1,89 @@
+import json
+import shutil
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+from ants_seg_to_nidm.antsutils import cde_file
+from ants_seg_to_nidm.validate import HEADER_BYTES, fetch, read_voxel_size, validate_manifest, validate_subject
+
+def test_read_voxel_size_example(example_inputs):
+    image = example_inputs["image"]
+    zooms = read_voxel_size(fetch(image, nbytes=HEADER_BYTES))
+    assert zooms == nib.load(image).header.get_zooms()[:3]
+
+
+@pytest.mark.parametrize(
+    "image_class,extension",
+    [
+        (nib.Nifti1Image, ".nii"),
+        (nib.Nifti1Image, ".nii.gz"),
+        (nib.Nifti2Image, ".nii"),
+        (nib.Nifti2Image, ".nii.gz"),
+        (nib.MGHImage, ".mgh"),
+        (nib.MGHImage, ".mgz"),
+    ],
+)
+def test_read_voxel_size_formats(tmp_path, image_class, extension):
+    image = tmp_path / ("image" + extension)
+    image_class(np.zeros((4, 5, 6), np.uint8), np.diag([0.5, 0.6, 0.7, 1])).to_filename(str(image))
+    zooms = read_voxel_size(fetch(str(image), nbytes=HEADER_BYTES))
+    assert np.allclose(zooms, (0.5, 0.6, 0.7))
+
+
+def test_read_voxel_size_unsupported():
+    with pytest.raises(ValueError, match="unsupported image format"):
+        read_voxel_size(b"not an image" * 100)
+
+
+@pytest.fixture(scope="module")
+def ants_cde():
+    return json.loads(Path(cde_file).read_text())
+
+
+@pytest.fixture
+def example_row(example_inputs):
+    return dict(example_inputs, subjid="0050002")
+
+
+def test_validate_subject_check_volumes(tmp_path, ants_cde, example_row, make_label_image):
+    labels = tmp_path / "labels.nii.gz"
+    make_label_image(pd.read_csv(example_row["labelstats"])).to_filename(str(labels))
+    # without a labels image the volumes are not checked against the tissue segmentation
+    assert validate_subject(example_row, ants_cde, volumes=True) == []
+    assert validate_subject(dict(example_row, labels=str(labels)), ants_cde, volumes=True) == []
+    errors = validate_subject(dict(example_row, labels=example_row["image"]), ants_cde, volumes=True)
+    assert errors and all("voxels in the label image" in error for error in errors)
+
+
+def test_validate_subject_check_volumes_url(ants_cde, example_row, make_label_image, http_server, tempdir):
+    root, url = http_server
+    make_label_image(pd.read_csv(example_row["labelstats"])).to_filename(str(root / "labels.nii"))
+    shutil.copy(example_row["image"], root / "seg.nii.gz")
+    row = dict(example_row, labels=url + "labels.nii")
+    assert validate_subject(row, ants_cde, volumes=True, max_bytes=2 ** 16) == []
+    errors = validate_subject(dict(row, labels=url + "seg.nii.gz"), ants_cde, volumes=True)
+    assert errors and all("voxels in the label image" in error for error in errors)
+    errors = validate_subject(dict(row, labels=url + "nothere.nii"), ants_cde, volumes=True)
+    assert len(errors) == 1 and errors[0].startswith("labels ")
+    assert list(tempdir.iterdir()) == []
+
+
+def test_validate_manifest_malformed_labelstats(tmp_path, example_row):
+    labelstats = tmp_path / "antslabelstats.csv"
+    labelstats.write_text("Label,VolumeInVoxels\n4,100\n,5\nabc,7\n")
+    rows = [dict(example_row, subjid="bad", labelstats=str(labelstats)), example_row]
+    results = validate_manifest(rows, nproc=2)
+    assert [subjid for subjid, _ in results] == ["bad", "0050002"]
+    assert results[0][1] == ["labelstats has 2 rows with a missing or non-numeric Label (nan)"]
+    assert results[1][1] == []
+
+
+def test_validate_subject_label_column_order(tmp_path, ants_cde, example_row):
+    ants_stats = pd.read_csv(example_row["labelstats"])
+    labelstats = tmp_path / "antslabelstats.csv"
+    ants_stats[list(ants_stats.columns[1:]) + ["Label"]].to_csv(labelstats, index=False)
+    assert validate_subject(dict(example_row, labelstats=str(labelstats)), ants_cde) == []